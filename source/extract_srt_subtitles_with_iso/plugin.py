@@ -4,7 +4,7 @@
 """
     Written by:               Josh.5 <jsunnex@gmail.com>, EdBaynes
     Date:                     11 May 2023, (16:41 AM)
- 
+
     Copyright:
         Copyright (C) 2021 Josh Sunnex
 
@@ -22,7 +22,9 @@
 import logging
 import os
 import re
-import babelfish
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
 
 from unmanic.libs.unplugins.settings import PluginSettings
 
@@ -31,6 +33,289 @@ from extract_srt_subtitles_with_iso.lib.ffmpeg import StreamMapper, Probe, Parse
 # Configure plugin logger
 logger = logging.getLogger("Unmanic.Plugin.extract_srt_subtitles_with_iso")
 
+# Map the 'language_code' setting to the babelfish attribute providing that format.
+# Built once at import so each stream resolves its format with a single dict lookup
+# instead of walking an if/elif chain.
+_LANGUAGE_CODE_FORMATS = {
+    '1': 'alpha2',         # ISO-639-1 2-letter format
+    '2': 'alpha3b',        # ISO-639-2/B 3-letter format
+    '3': 'alpha3',         # ISO-639-2/T 3-letter format
+    '4': 'opensubtitles',  # OpenSubtitles 3-letter format
+}
+
+
+# One regex scan of the stream title replaces the chains of 'in'/'and'/'or'
+# substring tests previously run per region. Compiled once at import.
+_REGION_HINT_RE = re.compile(
+    r'\b(?:united[\s-]*states|usa\b|united[\s-]*kingdom|great[\s-]*britain|uk\b'
+    r'|australia|zealand|canad|quebec|québéc|belgi|bra[sz]il|latin|americ|m[eé]xic)'
+)
+_HINT_SEPARATOR_RE = re.compile(r'[\s-]+')
+
+# Precompiled once here rather than recompiled (or re-fetched from the re cache)
+# for every subtitle stream. Matches runs of whitespace so 'English - SDH'
+# yields a single '-' rather than '---'.
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Tokenise the lowercased title once and test the hint words against frozensets.
+# Token membership also stops 'cc' and 'hi' matching inside unrelated words
+# (e.g. 'soccer', 'this').
+_TITLE_TOKEN_RE = re.compile(r'\w+')
+_SDH_HINTS = frozenset(('sdh', 'cc', 'hi'))
+_FORCED_HINTS = frozenset(('force', 'forced'))
+
+# Text based subtitle codecs this plugin can extract to SRT
+_TEXT_SUB_CODECS = frozenset(('srt', 'subrip', 'mov_text'))
+
+# Region Subtags keyed per language by the (separator-stripped) hint the regex matched.
+# Spanish maps the Latin American hints to '419'; _resolve_regional_tags decides between
+# the '.ea' and '.es-419' extensions from the 'latin_spanish' setting.
+_REGION_HINTS = {
+    'en': {
+        'unitedstates':  'US',
+        'usa':           'US',
+        'americ':        'US',
+        'unitedkingdom': 'GB',
+        'greatbritain':  'GB',
+        'uk':            'GB',
+        'australia':     'AU',
+        'canad':         'CA',
+        'zealand':       'NZ',
+    },
+    'fr': {
+        'canad':  'CA',
+        'quebec': 'CA',
+        'québéc': 'CA',
+        'belgi':  'BE',
+    },
+    'pt': {
+        'brazil': 'BR',
+        'brasil': 'BR',
+    },
+    'es': {
+        'mexic':  'MX',
+        'méxic':  'MX',
+        'latin':  '419',
+        'americ': '419',
+    },
+}
+
+
+# Subtitle stream specifiers for the '-map' args, prebuilt for as many streams
+# as a file realistically contains so mapping a stream is a tuple index rather
+# than a str.format call
+_SUB_STREAM_SPECIFIERS = tuple('0:s:{}'.format(i) for i in range(64))
+
+
+def _sub_stream_specifier(stream_id):
+    if stream_id < len(_SUB_STREAM_SPECIFIERS):
+        return _SUB_STREAM_SPECIFIERS[stream_id]
+    return '0:s:{}'.format(stream_id)
+
+
+def _resolve_regional_tags(alpha2, stream_title, latin_spanish):
+    """
+    Resolve a (language_tag_override, region_tag) pair from any regional hint
+    in the stream title. One regex scan plus one table lookup covers every
+    supported language; languages without _REGION_HINTS resolve to no region.
+    """
+    hints = _REGION_HINTS.get(alpha2)
+    if not hints:
+        return '', ''
+    match = _REGION_HINT_RE.search(stream_title)
+    if not match:
+        return '', ''
+    region_tag = hints.get(_HINT_SEPARATOR_RE.sub('', match.group(0)), '')
+    if region_tag == '419' and latin_spanish == '1':
+        # Use '.ea' extension For Latin American Spanish
+        return 'ea', ''
+    return '', region_tag
+
+
+# The babelfish converters to consult for a language code, keyed by code length
+_CONVERTERS_BY_LENGTH = {
+    2: ('alpha2',),
+    3: ('alpha3b', 'alpha3t', 'opensubtitles'),
+}
+
+
+@lru_cache(maxsize=512)
+def _resolve_language(stream_lang: str):
+    """
+    Resolve a language code to a babelfish Language object, trying the ISO-639-1,
+    ISO-639-2/B, ISO-639-2/T and OpenSubtitles converters as appropriate for the
+    code length. Unknown codes are rejected with a membership test against each
+    converter's code set rather than by raising LanguageReverseError. Cached so
+    each distinct code is resolved at most once per process; files commonly
+    repeat the same handful of codes across streams. Returns '' when the code
+    cannot be resolved.
+    """
+    # Deferred import: loading babelfish parses its ISO tables, which is wasted
+    # work for the many plugin imports that never reach a subtitle stream. The
+    # lru_cache means this only runs for codes not already resolved.
+    import babelfish
+
+    for converter_name in _CONVERTERS_BY_LENGTH.get(len(stream_lang), ()):
+        if stream_lang not in babelfish.language_converters[converter_name].codes:
+            continue
+        try:
+            return babelfish.Language.fromcode(stream_lang, converter_name)
+        except babelfish.LanguageReverseError:
+            continue
+    return ''
+
+
+# Snapshot order for the settings tuple passed to _compute_subtitle_tag
+_TAG_SETTING_KEYS = (
+    'language_code',
+    'use_sdh_extension',
+    'use_forced_extension',
+    'default_language',
+    'use_title_failback',
+    'use_regional',
+    'latin_spanish',
+)
+
+
+@lru_cache(maxsize=4096)
+def _compute_subtitle_tag(stream_lang: str, raw_title: str, settings_key: tuple) -> str:
+    """
+    Derive the subtitle file tag from a stream's language/title tags and the
+    plugin settings (a tuple in _TAG_SETTING_KEYS order). A pure function of
+    its arguments, cached because the same stream signature - e.g. 'eng' with
+    title 'English (SDH)' - repeats across thousands of files in a typical
+    library. Returns '' when no tag can be derived; the caller falls back to
+    numbering the file by stream index.
+    """
+    (language_code, use_sdh_extension, use_forced_extension, default_language,
+     use_title_failback, use_regional, latin_spanish) = settings_key
+
+    language_tag = ''
+    region_tag   = ''
+    sdh_tag      = ''
+    forced_tag   = ''
+    stream_title = raw_title.lower()
+
+    # If language is 'und' or blank use default language IF set
+    if stream_lang == 'und' or stream_lang == '':
+        stream_lang = default_language
+
+    language = _resolve_language(stream_lang)
+
+    if language:
+        format_attr = _LANGUAGE_CODE_FORMATS.get(language_code)
+        if format_attr:
+            language_tag = getattr(language, format_attr)
+
+        # A region hint can only come from the title, so skip the scan for
+        # untitled streams
+        if use_regional and stream_title:
+            try:
+                stream_alpha2 = language.alpha2
+            except Exception:
+                # Language has no ISO-639-1 code, so no regional handler applies
+                stream_alpha2 = ''
+            override_tag, region_tag = _resolve_regional_tags(stream_alpha2, stream_title, latin_spanish)
+            if override_tag:
+                language_tag = override_tag
+
+    elif stream_lang:
+        language_tag = stream_lang
+
+    # Only tokenise the title when there is one and an extension that needs it
+    if stream_title and (use_sdh_extension or use_forced_extension):
+        title_tokens = frozenset(_TITLE_TOKEN_RE.findall(stream_title))
+
+        # Check if the user selected a SDH extension
+        if use_sdh_extension:
+            # Check the title for Hearing Impared or SDH or CC information
+            if not _SDH_HINTS.isdisjoint(title_tokens):
+                sdh_tag = use_sdh_extension
+
+        # Check if the user selected a Forced extension
+        if use_forced_extension:
+            if not _FORCED_HINTS.isdisjoint(title_tokens):
+                forced_tag = use_forced_extension
+
+    tag_parts = []
+    if language_tag:
+        if region_tag:
+            tag_parts.append("{}-{}".format(language_tag, region_tag))
+        else:
+            tag_parts.append(language_tag)
+        if sdh_tag:
+            tag_parts.append(sdh_tag)
+        if forced_tag:
+            tag_parts.append(forced_tag)
+    elif use_title_failback and raw_title:
+        # If user choose to use Stream Description for tracks without a language
+        tag_parts.append(raw_title)
+
+    if not tag_parts:
+        return ''
+
+    # Join the parts once, each prefixed with the '.' separator
+    subtitle_tag = ''.join('.{}'.format(part) for part in tag_parts)
+
+    # Ensure subtitle tag does not contain whitespace
+    return _WHITESPACE_RE.sub('-', subtitle_tag)
+
+
+# Cache ffprobe data across runner invocations. The library test and worker
+# stages both probe the same path, and ffprobe forks a subprocess each time.
+# Keyed by path + mtime + size so a replaced or re-encoded file is re-probed.
+_PROBE_CACHE = OrderedDict()
+_PROBE_CACHE_MAX_ENTRIES = 16
+
+
+def _probe_file(abspath):
+    """
+    Return a configured Probe for the given path, reusing a cached ffprobe
+    result when the file on disk is unchanged. Returns None when the file
+    cannot be probed.
+    """
+    try:
+        file_stat = os.stat(abspath)
+        cache_key = (abspath, file_stat.st_mtime, file_stat.st_size)
+    except OSError:
+        cache_key = None
+
+    probe = Probe(logger, allowed_mimetypes=['video'])
+
+    if cache_key is not None:
+        cached_probe_info = _PROBE_CACHE.get(cache_key)
+        if cached_probe_info is not None:
+            _PROBE_CACHE.move_to_end(cache_key)
+            if probe.set_probe(cached_probe_info):
+                return probe
+
+    if not probe.file(abspath):
+        return None
+
+    if cache_key is not None:
+        _PROBE_CACHE[cache_key] = probe.get_probe()
+        while len(_PROBE_CACHE) > _PROBE_CACHE_MAX_ENTRIES:
+            _PROBE_CACHE.popitem(last=False)
+    return probe
+
+
+def _load_probe(data, abspath):
+    """
+    Return a Probe for the runner's file, preferring ffprobe data shared by an
+    earlier runner over spawning another ffprobe subprocess. Returns None when
+    no probe data can be loaded.
+    """
+    shared_probe_info = data.get('shared_info', {}).get('ffprobe')
+    if shared_probe_info:
+        probe = Probe(logger, allowed_mimetypes=['video'])
+        if probe.set_probe(shared_probe_info):
+            return probe
+        # Failed to set ffprobe from shared info.
+        # Probably due to it being for an incompatible mimetype declared above
+        return None
+    return _probe_file(abspath)
+
+
 class Settings(PluginSettings):
     settings = {
         "language_code":        '1',
@@ -128,168 +413,92 @@ class Settings(PluginSettings):
             }
         }
 
+@lru_cache(maxsize=4)
+def _configure_settings(library_id: int = None) -> Settings:
+    """
+    Resolve the Settings object for a library, cached so back-to-back tasks
+    against the same library do not rebuild it from the settings store.
+    Called without a library_id to maintain compatibility with v1 plugins.
+    """
+    if library_id:
+        return Settings(library_id=library_id)
+    return Settings()
+
+
 class PluginStreamMapper(StreamMapper):
+    # Store this class's per-instance attributes in slots rather than growing
+    # the instance dict inherited from StreamMapper
+    __slots__ = ('sub_streams', 'settings', 'settings_key')
+
     def __init__(self):
         super(PluginStreamMapper, self).__init__(logger, ['subtitle'])
         self.sub_streams = []
         self.settings = None
+        self.settings_key = ()
 
     def set_settings(self, settings):
         self.settings = settings
+        # Resolve the plugin settings once per file here; custom_stream_mapping runs
+        # once per subtitle stream and each get_setting() call walks the settings
+        # store. The snapshot doubles as the hashable key for the cached tag
+        # computation.
+        self.settings_key = tuple(settings.get_setting(key) for key in _TAG_SETTING_KEYS)
+
+    def streams_need_processing(self):
+        """
+        Check the probe once for subtitle streams before walking every stream.
+        Files without any subtitles (the common case) bail out here without
+        running the per-stream mapping logic at all.
+        """
+        streams = self.probe.get('streams')
+        if not streams:
+            return False
+        if not any(stream.get('codec_type', '').lower() == 'subtitle' for stream in streams):
+            return False
+        return super(PluginStreamMapper, self).streams_need_processing()
 
     def test_stream_needs_processing(self, stream_info: dict):
         """Any text based will need to be processed"""
-        if stream_info.get('codec_name').lower() in ['srt', 'subrip', 'mov_text']:
+        # Damaged containers can yield streams without a codec_name; treat them
+        # as not processable rather than aborting the whole file
+        codec_name = stream_info.get('codec_name')
+        if codec_name and codec_name.lower() in _TEXT_SUB_CODECS:
             return True
         return False
 
     def custom_stream_mapping(self, stream_info: dict, stream_id: int):
         # Find a tag for this subtitle
-        subtitle_tag = ''
         stream_tags = stream_info.get('tags', {})
 
-        language_tag = ''
-        region_tag   = ''
-        sdh_tag      = ''
-        forced_tag   = ''
-        stream_lang  = ''
-        stream_title = ''
-
-#       Get Plugin Settings
-        language_code           = self.settings.get_setting('language_code')
-        use_sdh_extension       = self.settings.get_setting('use_sdh_extension')
-        use_forced_extension    = self.settings.get_setting('use_forced_extension')
-        default_language        = self.settings.get_setting('default_language')
-        use_title_failback      = self.settings.get_setting('use_title_failback')
-        use_regional            = self.settings.get_setting('use_regional')
-        latin_spanish           = self.settings.get_setting('latin_spanish')
-
-        if stream_tags.get('language'):
-            stream_lang = stream_tags.get('language').lower()
-        if stream_tags.get('title'):
-            stream_title =  stream_tags.get('title').lower()
-
-        logger.debug("Processing Track: '{}'. Lang: {}. Title: {}".format(stream_info.get('index'), stream_lang, stream_title ))
-        
-#       If language is 'und' or blank use default language IF set
-        if stream_lang == 'und' or stream_lang == '':
-            stream_lang = default_language
-
-        if len(stream_lang) == 2:
-            try:
-                language = babelfish.Language.fromalpha2(stream_lang)
-            except:
-                language = ''
-        elif len(stream_lang) == 3:  
-            try:
-                language = babelfish.Language.fromalpha3b(stream_lang)
-            except:
-                try:
-                    language = babelfish.Language.fromalpha3t(stream_lang)
-                except:
-                    try:
-                        language = babelfish.Language.fromopensubtitles(stream_lang)
-                    except:
-                        language = ''
-        else:
-            language = ''
-
-        if language:
-            # Use ISO-639-1 2-letter format.        (example: en,  fr,  pt,  de,  nl,  zh,  el)
-            if language_code == '1':
-                language_tag = language.alpha2
-
-            # Use ISO-639-2/B 3-letter format.      (example: eng, fre, por, ger, dut, chi, gre)
-            elif language_code == '2':
-                language_tag = language.alpha3b
-
-            # Use ISO-639-2/T 3-letter format.      (example: eng, fra, por, deu, nld, zho, ell)
-            elif language_code == '3':
-                language_tag = language.alpha3
-
-            # Use OpenSubtitles 3-letter format.    (example: eng, fre, por, ger, dut, chi, ell)
-            elif language_code == '4':
-                language_tag = language.opensubtitles
-
-            if use_regional:
-                if language == 'en':                                        # ENGLISH
-                    if ( 'united' in stream_title and 'states' in stream_title ) or 'usa' in stream_title or 'america' in stream_title:
-                        region_tag = 'US'
-                    elif ( 'united' in stream_title and 'kingdom' in stream_title ) or ( 'great' in stream_title and 'britain' in stream_title ) or 'uk' in stream_title:
-                        region_tag = 'GB'
-                    elif 'australia' in stream_title:
-                        region_tag = 'AU'
-                    elif 'canad' in stream_title:
-                        region_tag = 'CA'
-                    elif 'zealand' in stream_title:
-                        region_tag = 'NZ'
-                    
-                elif language == 'fr':                                      # FRENCH
-                    if 'canad' in stream_title or 'quebec' in stream_title or 'québéc' in stream_title:
-                        region_tag = 'CA'
-                    elif 'belgi' in stream_title:
-                        region_tag = 'BE'
-
-                elif language == 'pt':                                      # PORTUGUESE
-                    if 'brazil' in stream_title or 'brasil' in stream_title:
-                        region_tag = 'BR'
-
-                elif language == 'es':                                      # SPANISH
-                    if 'mexic' in stream_title or 'méxic' in stream_title:
-                        region_tag = 'MX'
-                    if 'latin' in stream_title or 'america' in stream_title:
-                        if latin_spanish == '1':     # Use '.ea' extension For Latin American Spanish
-                            language_tag = 'ea'
-                        elif latin_spanish == '2':   # Use '.es-419' extension For Latin American Spanish
-                            region_tag = '419'
-        
-        elif stream_lang:
-            language_tag = stream_lang
-
-#       Check if the user selected a SDH extension
-        if use_sdh_extension:
-            # Check the title for Hearing Impared or SDH or CC information            
-            if 'sdh' in stream_title or 'cc' in stream_title or 'hi' in stream_title:
-                sdh_tag = use_sdh_extension
+#       Unpack the language/title tags once; they are reused throughout
+        raw_title   = stream_tags.get('title') or ''
+        stream_lang = (stream_tags.get('language') or '').lower()
 
-#       Check if the user selected a Forced extension
-        if use_forced_extension:
-            if 'force' in stream_title:
-                forced_tag = use_forced_extension                
-        
-        if language_tag:
-            subtitle_tag = "{}.{}".format(subtitle_tag, language_tag)
-            if region_tag:
-                subtitle_tag = "{}-{}".format(subtitle_tag, region_tag)
-            if sdh_tag:
-                subtitle_tag = "{}.{}".format(subtitle_tag, sdh_tag)
-            if forced_tag:
-                subtitle_tag = "{}.{}".format(subtitle_tag, forced_tag)
-           
-        else:
-#           If user choose to use Stream Description for tracks without a language
-            if use_title_failback and stream_title:
-                subtitle_tag = "{}.{}".format(subtitle_tag, stream_tags.get('title'))
+        logger.debug("Processing Track: '{}'. Lang: {}. Title: {}".format(stream_info.get('index'), stream_lang, raw_title))
+
+        # The tag is a pure function of the stream tags and the settings, so the
+        # heavy lifting lives in a cached module-level helper; repeat stream
+        # signatures across a library resolve with one cache hit
+        subtitle_tag = _compute_subtitle_tag(stream_lang, raw_title, self.settings_key)
 
         # If there were no tags, just number the file
         if not subtitle_tag:
-            subtitle_tag = "{}.{}".format(subtitle_tag, stream_info.get('index'))
-
-        # Ensure subtitle tag does not contain whitespace
-        subtitle_tag = re.sub('\s', '-', subtitle_tag)
+            subtitle_tag = '.{}'.format(stream_info.get('index'))
 
         self.sub_streams.append(
             {
                 'stream_id':      stream_id,
                 'subtitle_tag':   subtitle_tag,
-                'stream_mapping': ['-map', '0:s:{}'.format(stream_id)],
+                'stream_mapping': ['-map', _sub_stream_specifier(stream_id)],
             }
         )
 
-        # Copy the streams to the destination. This will actually do nothing...
+        # The extract args are emitted from sub_streams by on_worker_process.
+        # Return empty mappings so the base class does not accumulate duplicate
+        # '-map'/'-c copy' args that get_ffmpeg_args never emits anyway.
         return {
-            'stream_mapping':  ['-map', '0:s:{}'.format(stream_id)],
-            'stream_encoding': ['-c:s:{}'.format(stream_id), 'copy'],
+            'stream_mapping':  [],
+            'stream_encoding': [],
         }
 
     def get_ffmpeg_args(self):
@@ -335,22 +544,14 @@ def on_library_management_file_test(data):
 
     """
     # Configure settings object (maintain compatibility with v1 plugins)
-    if data.get('library_id'):
-        settings = Settings(library_id=data.get('library_id'))
-    else:
-        settings = Settings()
+    settings = _configure_settings(data.get('library_id'))
 
     # Get the path to the file
     abspath = data.get('path')
 
     # Get file probe
-    probe = Probe(logger, allowed_mimetypes=['video'])
-    if 'ffprobe' in data.get('shared_info', {}):
-        if not probe.set_probe(data.get('shared_info', {}).get('ffprobe')):
-            # Failed to set ffprobe from shared info.
-            # Probably due to it being for an incompatible mimetype declared above
-            return
-    elif not probe.file(abspath):
+    probe = _load_probe(data, abspath)
+    if not probe:
         # File probe failed, skip the rest of this test
         return
     # Set file probe to shared infor for subsequent file test runners
@@ -398,47 +599,46 @@ def on_worker_process(data):
     # Get the path to the file
     abspath = data.get('file_in')
 
-    # Get file probe
-    probe = Probe(logger, allowed_mimetypes=['video'])
-    if not probe.file(abspath):
+    # Get file probe, reusing any ffprobe data shared by the library file test
+    probe = _load_probe(data, abspath)
+    if not probe:
         # File probe failed, skip the rest of this test
         return
 
     # Configure settings object (maintain compatibility with v1 plugins)
-    if data.get('library_id'):
-        settings = Settings(library_id=data.get('library_id'))
-    else:
-        settings = Settings()
+    settings = _configure_settings(data.get('library_id'))
 
     # Get stream mapper
     mapper = PluginStreamMapper()
     mapper.set_settings(settings)
     mapper.set_probe(probe)
 
+    # Parse the original file path once; the directory comes from the splitext stem
     split_original_file_path = os.path.splitext(data.get('original_file_path'))
-    original_file_directory = os.path.dirname(data.get('original_file_path'))
+    original_file_directory = os.path.dirname(split_original_file_path[0])
 
     if mapper.streams_need_processing():
         # Set the input file
         mapper.set_input_file(abspath)
 
-        # Get generated ffmpeg args
-        ffmpeg_args = mapper.get_ffmpeg_args()
-
-        # Append STR extract args
-        for sub_stream in mapper.sub_streams:
-            stream_mapping = sub_stream.get('stream_mapping', [])
-            subtitle_tag = sub_stream.get('subtitle_tag')
-
-            ffmpeg_args += stream_mapping
-            ffmpeg_args += [
-                "-y",
-                os.path.join(original_file_directory, "{}{}.srt".format(split_original_file_path[0], subtitle_tag)),
-            ]
+        # Output file paths share this prefix; resolve it once outside the loop
+        output_prefix = os.path.join(original_file_directory, split_original_file_path[0])
+
+        # Append the STR extract args to the generated ffmpeg args in a single
+        # pass - one map/output pair per subtitle stream, all extracted by this
+        # one ffmpeg invocation. The global '-y' overwrite flag is stated once
+        # rather than repeated per output file.
+        exec_command = ['ffmpeg']
+        exec_command.extend(mapper.get_ffmpeg_args())
+        exec_command.append('-y')
+        exec_command.extend(chain.from_iterable(
+            sub_stream.get('stream_mapping', [])
+            + ["{}{}.srt".format(output_prefix, sub_stream.get('subtitle_tag'))]
+            for sub_stream in mapper.sub_streams
+        ))
 
         # Apply ffmpeg args to command
-        data['exec_command'] = ['ffmpeg']
-        data['exec_command'] += ffmpeg_args
+        data['exec_command'] = exec_command
 
         # Set the parser
         parser = Parser(logger)